@@ -14,6 +14,12 @@ app.logger.addHandler(log)
 
 load_dotenv(override = True)
 SITE_URL = os.getenv("AUTH_URL")
+INTERACTIONS_ENDPOINT = os.getenv("INTERACTIONS_ENDPOINT", "false").lower() == "true"
+
+if INTERACTIONS_ENDPOINT:
+    # serve slash commands and buttons over HTTP, see http_interactions.py
+    from http_interactions import interactions
+    app.register_blueprint(interactions)
 
 async def validate_sig(body):
     # get nonce from db
@@ -10,6 +10,7 @@ from datetime import datetime, timedelta
 from utils.logger import get_logger
 import utils.idena as idena
 import utils.db as db
+from utils.role_queue import RoleUpdateQueue, INTERACTIVE, BULK
 
 log = get_logger("BOT")
 
@@ -17,12 +18,65 @@ load_dotenv(override = True)
 DISCORD_TOKEN = os.getenv("DISCORD_TOKEN")
 AUTH_URL = os.getenv("AUTH_URL")
 BOT_OWNER = int(os.getenv("BOT_OWNER"))
+IDENTITY_SYNC = os.getenv("IDENTITY_SYNC", "false").lower() == "true"
+INTERACTIONS_ENDPOINT = os.getenv("INTERACTIONS_ENDPOINT", "false").lower() == "true"
+
+# role jobs are polled every half second, waiters give up before the interaction token expires
+ROLE_JOB_INTERVAL = 0.5
+ROLE_JOB_TIMEOUT = 14 * 60
+FORCE_UPDATE_COOLDOWN = 60 * 60
 
 # Create discord bot
 intents = disnake.Intents.default()
 intents.members = True
 bot = commands.InteractionBot(intents = intents)
 
+# all role updates go through this queue so user requests are served before bulk updates
+role_queue = RoleUpdateQueue()
+# set by http_interactions.py, role updates are then handed to the gateway process so they all go through its queue
+forward_role_updates = False
+# the scheduled update and the sync task must not pull the identity set at the same time
+identity_sync_lock = asyncio.Lock()
+# full updates forwarded to the gateway process, guild_id (None for all guilds) -> running task / last /forceupdateall
+bulk_runs = {}
+bulk_cooldowns = {}
+
+async def get_identity_state(address: str) -> str:
+    if not IDENTITY_SYNC:
+        return await idena.get_identity_state(address)
+
+    # read from the local identity mirror, fetch and store addresses it doesn't know yet
+    state = await db.get_identity_state(address)
+    if state is None:
+        state = await mirror_identity_state(address, await db.get_identities_epoch())
+    if state is None:
+        state = await idena.get_identity_state(address)
+    return state
+
+async def mirror_identity_state(address: str, epoch: int) -> str:
+    # only states returned by the node are stored, fallback and undefined results may be transient errors
+    try:
+        state = await idena.get_node_identity_state(address)
+    except Exception as e:
+        log.error(f"Error fetching identity state for {address} from the node: {e}")
+        return None
+    if state.lower() != "undefined":
+        await db.set_identity_state(address, state, epoch)
+    return state
+
+async def sync_identities():
+    # full mirror refresh once per epoch, linked addresses missing from it are added one by one
+    async with identity_sync_lock:
+        try:
+            epoch = await idena.get_epoch()
+            if epoch != await db.get_identities_epoch():
+                log.info(f"Syncing identities for epoch {epoch}")
+                await db.set_identities(await idena.get_all_identities(), epoch)
+            for address in await db.get_unsynced_addresses():
+                await mirror_identity_state(address, epoch)
+        except Exception as e:
+            log.error(f"Error syncing identities: {e}")
+
 async def update_role(guild: disnake.Guild, member: disnake.Member) -> str:
     # get role id based on Idena status
     address = await db.get_user_address(member.id)
@@ -39,7 +93,7 @@ async def update_role(guild: disnake.Guild, member: disnake.Member) -> str:
         return ""
     
     # idena state
-    state = await idena.get_identity_state(address)
+    state = await get_identity_state(address)
     if state.lower() not in ["undefined", "newbie", "verified", "human", "suspended", "zombie"]:
         state = "undefined"
 
@@ -69,7 +123,68 @@ async def update_role(guild: disnake.Guild, member: disnake.Member) -> str:
 
     return role_id
 
-async def update_all_roles(guild_id: int = None):
+def queue_role_update(guild: disnake.Guild, member: disnake.Member, priority: int = INTERACTIVE):
+    if forward_role_updates:
+        return forward_role_job(guild.id, member.id, priority)
+    return role_queue.submit(guild.id, member.id, lambda: update_role(guild, member), priority)
+
+async def forward_role_job(guild_id: int, user_id: int = None, priority: int = INTERACTIVE, cooldown: bool = False):
+    # runs a role update in the gateway process and waits for its result
+    job_id = await db.add_role_job(guild_id, user_id, priority, cooldown)
+    try:
+        for _ in range(int(ROLE_JOB_TIMEOUT / ROLE_JOB_INTERVAL)):
+            await asyncio.sleep(ROLE_JOB_INTERVAL)
+            status, result = await db.get_role_job(job_id)
+            if status == "done":
+                return int(result) if result else ""
+            if status == "failed":
+                raise Exception(result)
+            if status == "cooldown":
+                raise commands.CommandOnCooldown(commands.Cooldown(1, FORCE_UPDATE_COOLDOWN), float(result), commands.BucketType.guild)
+        raise Exception(f"Role job {job_id} was not processed in time, is the gateway process running?")
+    finally:
+        await db.remove_role_job(job_id)
+
+async def run_bulk_role_job(job_id: int, guild_id: int, cooldown: bool):
+    # the forceupdateall cooldown is kept here because every web worker tracks its own
+    if guild_id not in bulk_runs:
+        if cooldown and guild_id in bulk_cooldowns:
+            retry_after = (bulk_cooldowns[guild_id] + timedelta(seconds = FORCE_UPDATE_COOLDOWN) - datetime.now()).total_seconds()
+            if retry_after > 0:
+                return await db.finish_role_job(job_id, str(retry_after), "cooldown")
+        if cooldown:
+            bulk_cooldowns[guild_id] = datetime.now()
+        bulk_runs[guild_id] = asyncio.create_task(update_all_roles(guild_id))
+        bulk_runs[guild_id].add_done_callback(lambda _: bulk_runs.pop(guild_id, None))
+
+    # requests for a guild that is being updated already share that run
+    await asyncio.shield(bulk_runs[guild_id])
+    await db.finish_role_job(job_id, "")
+
+async def run_role_job(job_id: int, guild_id: int, user_id: int, priority: int, cooldown: bool):
+    try:
+        if user_id is None:
+            return await run_bulk_role_job(job_id, guild_id, cooldown)
+        guild = bot.get_guild(guild_id) or await bot.fetch_guild(guild_id)
+        member = guild.get_member(user_id) or await guild.fetch_member(user_id)
+        result = await queue_role_update(guild, member, priority)
+        await db.finish_role_job(job_id, str(result))
+    except Exception as e:
+        log.error(f"Error running role job {job_id}: {e}")
+        await db.finish_role_job(job_id, str(e), "failed")
+
+async def role_job_update():
+    # runs the role updates forwarded by the HTTP interactions endpoint
+    while True:
+        for job_id, guild_id, user_id, priority, cooldown in await db.take_role_jobs():
+            asyncio.create_task(run_role_job(job_id, guild_id, user_id, priority, cooldown))
+        await asyncio.sleep(ROLE_JOB_INTERVAL)
+
+async def update_all_roles(guild_id: int = None, cooldown: bool = False):
+    # cooldown only applies to forwarded updates, the gateway's /forceupdateall has its own
+    if forward_role_updates:
+        return await forward_role_job(guild_id, None, BULK, cooldown)
+
     log.info("Updating all roles")
     if guild_id:
         guilds = [guild_id]
@@ -77,6 +192,7 @@ async def update_all_roles(guild_id: int = None):
         guilds = await db.get_guilds()
 
     users = await db.get_all_users()
+    updates = []
     for guild_id in guilds:
         if not await db.is_guild_configured(guild_id):
             log.warning(f"Guild {await bot.fetch_guild(guild_id)}({guild_id}) not configured, skipping update")
@@ -90,15 +206,19 @@ async def update_all_roles(guild_id: int = None):
             log.error(f"Guild {guild_id} not found, skipping update")
             continue
 
+        # queue the updates of every guild first so the queue can interleave them
         fetched_users = await guild.fetch_members().flatten()
         for user_id in users:
-            try:
-                user = next((user for user in fetched_users if user.id == user_id), None)
-                if user is None:
-                    continue
-                await update_role(guild, user)
-            except Exception as e:
-                log.error(f"Error updating roles for user {(await bot.fetch_user(user_id)).name}({user_id}) in guild {guild}({guild_id}): {e}")
+            user = next((user for user in fetched_users if user.id == user_id), None)
+            if user is None:
+                continue
+            updates.append((guild, user, queue_role_update(guild, user, BULK)))
+
+    for guild, user, update in updates:
+        try:
+            await update
+        except Exception as e:
+            log.error(f"Error updating roles for user {user.name}({user.id}) in guild {guild}({guild.id}): {e}")
 
     log.info("All roles updated")
 
@@ -113,6 +233,8 @@ async def scheduled_update(hour, minute):
         wait_seconds = (target_time - now).total_seconds()
         await asyncio.sleep(wait_seconds)
         
+        if IDENTITY_SYNC:
+            await sync_identities()
         await update_all_roles()
 
 async def hourly_update():
@@ -124,6 +246,12 @@ async def hourly_update():
         await bot.change_presence(activity = disnake.Activity(type = disnake.ActivityType.watching, name = f"{user_count} Idena identities"))
         await asyncio.sleep(60 * 60)
 
+async def identity_sync_update():
+    # checks for a new epoch every 10 minutes and keeps the identity mirror in sync
+    while True:
+        await sync_identities()
+        await asyncio.sleep(10 * 60)
+
 async def protect(cmd: disnake.CommandInteraction):
     # checks if the user has permission to use the command
     bot_manager = await db.get_bot_manager(cmd.guild.id)
@@ -205,7 +333,7 @@ async def setbotmanager(cmd: disnake.CommandInteraction, role: disnake.Role):
 #
 # force update all command
 #
-@commands.cooldown(1, 60 * 60, commands.BucketType.guild)
+@commands.cooldown(1, FORCE_UPDATE_COOLDOWN, commands.BucketType.guild)
 @bot.slash_command(description = "Force update all roles for all users")
 async def forceupdateall(cmd: disnake.CommandInteraction):
     if await protect(cmd) != 1:
@@ -223,7 +351,7 @@ async def forceupdateall(cmd: disnake.CommandInteraction):
     
     await cmd.response.defer()
 
-    await update_all_roles(cmd.guild.id)
+    await update_all_roles(cmd.guild.id, cooldown = True)
 
     description = "Roles have been updated for all users!"
     embed = Embed(title = "<a:tick:1279114111963369503> Roles Updated", description = description, color = 0x43b481)
@@ -267,7 +395,7 @@ async def send_interactive_message(cmd: disnake.CommandInteraction, channel: dis
     logout_button = disnake.ui.Button(style = disnake.ButtonStyle.danger, label = "Logout", custom_id = "logout")
 
     # create interactive message
-    idena_emoji = bot.get_emoji(685155510131097625)
+    idena_emoji = "<:idena:685155510131097625>" # markup works without the emoji cache of the gateway
     description = "This server uses an Idena Identity verification system.\nYou can obtain roles based on your Idena status by signing in with Idena using the buttons below."
     embed = disnake.Embed(title = f"{idena_emoji} Idena Auth", description = description, color = 0x1215b5)
     await channel.send(embed = embed, components = [disnake.ui.ActionRow(login_button, update_button, logout_button)])
@@ -303,7 +431,7 @@ async def login(cmd: disnake.CommandInteraction):
 @commands.cooldown(3, 60, commands.BucketType.user)
 @bot.slash_command(description = "Update your roles")
 async def update(cmd: disnake.CommandInteraction):
-    role_id = await update_role(cmd.guild, cmd.author)
+    role_id = await queue_role_update(cmd.guild, cmd.author)
 
     if role_id == "":
         description = "You are not logged in!"
@@ -335,7 +463,7 @@ async def logout(cmd: disnake.CommandInteraction):
         try:
             guild = await bot.fetch_guild(guild_id)
             member = await guild.fetch_member(cmd.author.id)
-            await update_role(guild, member)
+            await queue_role_update(guild, member)
         except disnake.errors.NotFound:
             log.debug(f"Member {cmd.author.name}({cmd.author.id}) not found in guild {guild}({guild.id})")
         except Exception as e:
@@ -423,7 +551,13 @@ async def on_slash_command_error(ctx, error):
 @bot.event
 async def on_ready():
     log.info(f"Logged in as {bot.user}")
+    role_queue.start()
     asyncio.create_task(scheduled_update(15, 45))
     asyncio.create_task(hourly_update())
+    if IDENTITY_SYNC:
+        asyncio.create_task(identity_sync_update())
+    if INTERACTIONS_ENDPOINT:
+        asyncio.create_task(role_job_update())
 
-bot.run(DISCORD_TOKEN)
\ No newline at end of file
+if __name__ == "__main__":
+    bot.run(DISCORD_TOKEN)
\ No newline at end of file
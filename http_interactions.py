@@ -0,0 +1,230 @@
+import os
+import asyncio
+import aiohttp
+import threading
+import concurrent.futures
+from types import SimpleNamespace
+import disnake
+from disnake import Embed, OptionType
+from aiocache import cached
+from flask import Blueprint, jsonify, request
+from nacl.signing import VerifyKey
+from nacl.exceptions import BadSignatureError
+from dotenv import load_dotenv
+from utils.logger import get_logger
+import bot as gateway
+from bot import bot, button_listener, before_slash_command_invoke, on_slash_command_error
+
+# Serves Discord interactions (slash commands and buttons) over HTTP next to the auth routes.
+# The handlers from bot.py are reused as they are, HTTPInteraction provides the attributes they use.
+# Discord REST calls run on a background event loop with a REST only login of the bot.
+# Role updates are handed to the gateway process through bot.db so they all go through its queue.
+
+log = get_logger("INTERACTIONS")
+
+load_dotenv(override = True)
+DISCORD_TOKEN = os.getenv("DISCORD_TOKEN")
+DISCORD_PUBLIC_KEY = os.getenv("DISCORD_PUBLIC_KEY")
+DISCORD_API = "https://discord.com/api/v10"
+
+# interaction and callback types from the Discord API
+PING = 1
+MESSAGE_COMPONENT = 3
+PONG = 1
+CHANNEL_MESSAGE = 4
+DEFERRED_CHANNEL_MESSAGE = 5
+EPHEMERAL = 1 << 6
+
+# Discord expects the initial response within 3 seconds, slower handlers get deferred
+RESPONSE_TIMEOUT = 2.5
+# commands that reply ephemerally, button replies always are
+EPHEMERAL_COMMANDS = ["login", "update", "logout"]
+
+interactions = Blueprint("interactions", __name__)
+verify_key = VerifyKey(bytes.fromhex(DISCORD_PUBLIC_KEY))
+
+#
+# disnake compatibility shim
+# disnake has no HTTP interactions support, the endpoint drives the bot without a gateway connection
+# through the private internals below. They were checked against disnake 2.9.1, check them again when upgrading.
+#
+DISNAKE_VERSION = "2.9.1"
+if disnake.__version__ != DISNAKE_VERSION:
+    raise ImportError(f"http_interactions.py supports disnake {DISNAKE_VERSION} only, found {disnake.__version__}")
+
+def bind_loop(loop: asyncio.AbstractEventLoop):
+    # the bot was created outside of this loop, disnake schedules its rate limit handling on bot.loop
+    bot.loop = bot.http.loop = loop
+
+def check_cooldown(command, inter):
+    # raises CommandOnCooldown like a gateway invocation would
+    command._prepare_cooldowns(inter)
+
+def connection_state():
+    return bot._connection
+
+#
+# background event loop
+#
+loop = None
+loop_lock = threading.Lock()
+
+def get_loop() -> asyncio.AbstractEventLoop:
+    # started lazily so every gunicorn worker gets its own loop and session
+    global loop
+    with loop_lock:
+        if loop is None:
+            new_loop = asyncio.new_event_loop()
+            thread = threading.Thread(target = new_loop.run_forever, daemon = True)
+            thread.start()
+            try:
+                asyncio.run_coroutine_threadsafe(start(), new_loop).result()
+            except Exception:
+                # the next interaction tries again with a new loop
+                new_loop.call_soon_threadsafe(new_loop.stop)
+                thread.join()
+                new_loop.close()
+                raise
+            loop = new_loop
+    return loop
+
+async def start():
+    bind_loop(asyncio.get_running_loop())
+    await bot.login(DISCORD_TOKEN)
+    gateway.forward_role_updates = True
+    log.info(f"Serving interactions over HTTP as {bot.user}")
+
+@cached(ttl = 15)
+async def get_guild(guild_id: int) -> disnake.Guild:
+    return await bot.fetch_guild(guild_id)
+
+def message_data(content = None, embed = None, ephemeral = False) -> dict:
+    data = {}
+    if content is not None:
+        data["content"] = content
+    if embed is not None:
+        data["embeds"] = [embed.to_dict()]
+    if ephemeral:
+        data["flags"] = EPHEMERAL
+    return data
+
+class HTTPResponse:
+    # stands in for disnake.InteractionResponse
+    def __init__(self, inter):
+        self.inter = inter
+
+    async def send_message(self, content = None, embed = None, ephemeral = False):
+        data = message_data(content, embed, ephemeral)
+        if not self.inter.respond({"type": CHANNEL_MESSAGE, "data": data}):
+            # the interaction was deferred already because the handler took too long
+            await self.inter.edit_original_message(content, embed)
+
+    async def defer(self, with_message = True, ephemeral = False):
+        if not self.inter.respond({"type": DEFERRED_CHANNEL_MESSAGE, "data": message_data(ephemeral = ephemeral)}):
+            log.warning(f"Interaction {self.inter.id} was deferred already, ignoring defer(ephemeral = {ephemeral})")
+
+class HTTPInteraction:
+    # stands in for disnake.CommandInteraction and disnake.MessageInteraction
+    def __init__(self, payload, guild, author, initial_response: concurrent.futures.Future):
+        self.id = int(payload["id"])
+        self.application_id = payload["application_id"]
+        self.token = payload["token"]
+        self.created_at = disnake.utils.snowflake_time(self.id)
+        self.guild = guild
+        self.author = author
+        self.data = SimpleNamespace(name = payload["data"].get("name"))
+        self.component = SimpleNamespace(custom_id = payload["data"].get("custom_id"))
+        self.response = HTTPResponse(self)
+        self.initial_response = initial_response
+
+    def respond(self, response: dict) -> bool:
+        # returns False if the initial response was sent already
+        try:
+            self.initial_response.set_result(response)
+            return True
+        except concurrent.futures.InvalidStateError:
+            return False
+
+    async def edit_original_message(self, content = None, embed = None):
+        url = f"{DISCORD_API}/webhooks/{self.application_id}/{self.token}/messages/@original"
+        async with aiohttp.ClientSession() as session:
+            for _ in range(3):
+                async with session.patch(url, json = message_data(content, embed)) as response:
+                    # the deferred response may not have reached Discord yet
+                    if response.status != 404:
+                        response.raise_for_status()
+                        return
+                await asyncio.sleep(1)
+        raise Exception(f"Could not edit original response of interaction {self.id}")
+
+def get_author(payload, guild):
+    if guild is None:
+        return disnake.User(state = connection_state(), data = payload["user"])
+    return disnake.Member(state = connection_state(), guild = guild, data = payload["member"])
+
+async def get_options(guild, data) -> dict:
+    # converts option values to the types the slash command handlers take
+    kwargs = {}
+    for option in data.get("options", []):
+        value = option["value"]
+        if option["type"] == OptionType.role.value:
+            # roles created after the guild was cached are only in the resolved data
+            value = guild.get_role(int(value)) or disnake.Role(guild = guild, state = connection_state(), data = data["resolved"]["roles"][value])
+        elif option["type"] == OptionType.channel.value:
+            value = await bot.fetch_channel(int(value))
+        kwargs[option["name"]] = value
+    return kwargs
+
+async def dispatch(payload, initial_response: concurrent.futures.Future):
+    try:
+        guild = await get_guild(int(payload["guild_id"])) if "guild_id" in payload else None
+        inter = HTTPInteraction(payload, guild, get_author(payload, guild), initial_response)
+
+        if payload["type"] == MESSAGE_COMPONENT:
+            return await button_listener(inter)
+
+        command = bot.get_slash_command(inter.data.name)
+        if command is None:
+            raise Exception(f"Unknown command {inter.data.name}")
+        try:
+            await before_slash_command_invoke(inter)
+            check_cooldown(command, inter)
+            await command(inter, **await get_options(guild, payload["data"]))
+        except Exception as e:
+            await on_slash_command_error(inter, e)
+    except Exception as e:
+        log.error(f"An error occurred in HTTP interaction {payload['id']}: {e}")
+    finally:
+        if not initial_response.done():
+            description = f"Something went wrong! :("
+            embed = Embed(title = "<a:cross:1279119277705789450> Error", description = description, color = 0xf04947)
+            try:
+                initial_response.set_result({"type": CHANNEL_MESSAGE, "data": message_data(embed = embed, ephemeral = True)})
+            except concurrent.futures.InvalidStateError:
+                pass # deferred by the endpoint in the meantime
+
+@interactions.route("/interactions", methods = ["POST"])
+def handle_interaction():
+    signature = request.headers.get("X-Signature-Ed25519", "")
+    timestamp = request.headers.get("X-Signature-Timestamp", "")
+    try:
+        verify_key.verify(timestamp.encode() + request.get_data(), bytes.fromhex(signature))
+    except (BadSignatureError, ValueError):
+        log.warning("Rejected interaction with invalid signature")
+        return "Invalid request signature", 401
+
+    payload = request.get_json()
+    if payload["type"] == PING:
+        return jsonify({"type": PONG})
+
+    initial_response = concurrent.futures.Future()
+    asyncio.run_coroutine_threadsafe(dispatch(payload, initial_response), get_loop())
+    try:
+        return jsonify(initial_response.result(timeout = RESPONSE_TIMEOUT))
+    except TimeoutError:
+        ephemeral = payload["type"] == MESSAGE_COMPONENT or payload["data"].get("name") in EPHEMERAL_COMMANDS
+        try:
+            initial_response.set_result({"type": DEFERRED_CHANNEL_MESSAGE, "data": message_data(ephemeral = ephemeral)})
+        except concurrent.futures.InvalidStateError:
+            pass # the handler responded in the meantime
+        return jsonify(initial_response.result())
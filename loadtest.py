@@ -0,0 +1,191 @@
+import os
+import math
+import time
+import random
+import sqlite3
+import asyncio
+import logging
+import argparse
+import aiohttp
+from concurrent.futures import ProcessPoolExecutor
+from eth_keys.main import PrivateKey
+from Crypto.Hash import keccak
+from dotenv import load_dotenv
+import utils.db as db
+from utils.logger import get_logger
+
+# Load generator for the sign-in flow served by auth.py
+# Run it from the same directory as the auth instance so both use the same bot.db and bot.log
+
+log = get_logger("LOADTEST")
+logging.getLogger("DB").setLevel(logging.WARNING) # don't log every generated token
+
+load_dotenv(override = True)
+
+STAGES = ["token", "start-session", "authenticate", "total"]
+CLEANUP_CHUNK = 500 # stays below SQLite's limit of variables per statement
+
+def sign_nonce(private_key: bytes, nonce: str) -> str:
+    # same double keccak hash that auth.validate_sig expects
+    # runs in a worker process, signing is pure Python and would stall the measured event loop
+    hash = keccak.new(digest_bits=256)
+    hash.update(nonce.encode('utf-8'))
+    nonce_hash = hash.digest()
+    hash = keccak.new(digest_bits=256)
+    hash.update(nonce_hash)
+    nonce_hash = hash.digest()
+
+    signature = PrivateKey(private_key).sign_msg_hash(nonce_hash)
+    return "0x" + signature.to_bytes().hex()
+
+def percentile(values, p):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    index = max(0, min(len(values) - 1, math.ceil(p / 100 * len(values)) - 1))
+    return values[index]
+
+class Stats:
+    def __init__(self):
+        self.latencies = {stage: [] for stage in STAGES}
+        self.errors = {}
+        self.completed = 0
+        self.token_lock_errors = 0
+        self.server_errors = {"start-session": 0, "authenticate": 0}
+        self.server_lock_errors = 0
+
+    def error(self, reason: str):
+        self.errors[reason] = self.errors.get(reason, 0) + 1
+
+async def post(session: aiohttp.ClientSession, url: str, stage: str, body: dict, stats: Stats) -> dict:
+    async with session.post(url + "/" + stage, json = body) as response:
+        if response.status != 200:
+            if response.status == 500:
+                stats.server_errors[stage] += 1
+            raise RuntimeError(f"HTTP {response.status}")
+        return await response.json()
+
+async def generate_token(user_id: int, stats: Stats) -> str:
+    # runs before the timed run, the sqlite write would block the measured event loop
+    start = time.perf_counter()
+    try:
+        token = await db.generate_token(str(user_id))
+    except sqlite3.OperationalError as e:
+        stats.token_lock_errors += "locked" in str(e)
+        stats.error(f"token: {e}")
+        return None
+    stats.latencies["token"].append(time.perf_counter() - start)
+    return token
+
+async def sign_in(session: aiohttp.ClientSession, url: str, token: str, keypair: tuple, signer: ProcessPoolExecutor, stats: Stats):
+    private_key, address = keypair
+    start = time.perf_counter()
+
+    try:
+        stage_start = time.perf_counter()
+        response = await post(session, url, "start-session", {"token": token, "address": address}, stats)
+        stats.latencies["start-session"].append(time.perf_counter() - stage_start)
+        if not response["success"]:
+            return stats.error(f"start-session: {response['error']}")
+
+        # client side signing time is left out of the total
+        signing_start = time.perf_counter()
+        signature = await asyncio.get_running_loop().run_in_executor(signer, sign_nonce, private_key, response["data"]["nonce"])
+        start += time.perf_counter() - signing_start
+
+        stage_start = time.perf_counter()
+        response = await post(session, url, "authenticate", {"token": token, "signature": signature}, stats)
+        stats.latencies["authenticate"].append(time.perf_counter() - stage_start)
+        if not response["success"]:
+            return stats.error(f"authenticate: {response['error']}")
+    except Exception as e:
+        return stats.error(f"request: {e}")
+
+    stats.latencies["total"].append(time.perf_counter() - start)
+    stats.completed += 1
+
+def generate_keypair() -> tuple:
+    private_key = PrivateKey(os.urandom(32))
+    return private_key.to_bytes(), private_key.public_key.to_address()
+
+def log_size() -> int:
+    try:
+        return os.path.getsize("bot.log")
+    except OSError:
+        return 0
+
+def count_lock_errors(offset: int) -> int:
+    # auth.py logs failed requests with their traceback to bot.log, reading it doesn't add load to bot.db
+    try:
+        with open("bot.log", encoding = "utf-8", errors = "replace") as file:
+            file.seek(offset)
+            return file.read().count("database is locked")
+    except OSError:
+        return 0
+
+async def run(url: str, users: int, concurrency: int, signers: int) -> Stats:
+    stats = Stats()
+    semaphore = asyncio.Semaphore(concurrency)
+    # synthetic discord ids, far above real snowflakes so they never collide with real users
+    user_ids = random.sample(range(9 * 10 ** 18, 9 * 10 ** 18 + 10 ** 9), users)
+    log.info(f"Generating {users} keypairs")
+    keypairs = [generate_keypair() for _ in user_ids]
+
+    async def worker(session, token, keypair):
+        async with semaphore:
+            await sign_in(session, url, token, keypair, signer, stats)
+
+    signer = ProcessPoolExecutor(signers)
+    try:
+        log.info(f"Generating {users} tokens")
+        tokens = [await generate_token(user_id, stats) for user_id in user_ids]
+
+        log_offset = log_size()
+        start = time.perf_counter()
+        connector = aiohttp.TCPConnector(limit = concurrency)
+        async with aiohttp.ClientSession(connector = connector) as session:
+            await asyncio.gather(*[worker(session, token, keypair) for token, keypair in zip(tokens, keypairs) if token is not None])
+        elapsed = time.perf_counter() - start
+        stats.server_lock_errors = count_lock_errors(log_offset)
+    finally:
+        signer.shutdown()
+        cleanup(user_ids, [address for _, address in keypairs])
+
+    report(stats, users, concurrency, elapsed)
+    return stats
+
+def cleanup(user_ids, addresses):
+    # remove everything the run created, including addresses the identity mirror picked up
+    user_ids = [str(user_id) for user_id in user_ids]
+    addresses = [address.lower() for address in addresses]
+    with db.lock:
+        for table, column, values in [("users", "user_id", user_ids), ("pending_auth", "user_id", user_ids), ("identities", "address", addresses)]:
+            for i in range(0, len(values), CLEANUP_CHUNK):
+                chunk = values[i:i + CLEANUP_CHUNK]
+                db.cursor.execute(f"DELETE FROM {table} WHERE {column} IN ({','.join('?' * len(chunk))})", chunk)
+        db.conn.commit()
+
+def report(stats: Stats, users: int, concurrency: int, elapsed: float):
+    failed = users - stats.completed
+    log.info(f"{users} sign-ins at concurrency {concurrency} in {elapsed:.2f}s ({stats.completed / elapsed:.1f} successful sign-ins/s)")
+    for stage in STAGES:
+        latencies = stats.latencies[stage]
+        if not latencies:
+            continue
+        log.info(f"{stage:>14}: p50 {percentile(latencies, 50) * 1000:.1f}ms, p95 {percentile(latencies, 95) * 1000:.1f}ms, p99 {percentile(latencies, 99) * 1000:.1f}ms ({len(latencies)} samples){' before the timed run' if stage == 'token' else ''}")
+    log.info(f"Errors: {failed}/{users} ({failed / users * 100:.2f}%)")
+    for reason, count in sorted(stats.errors.items(), key = lambda item: -item[1]):
+        log.info(f"  {count}x {reason}")
+    server_errors = ", ".join(f"{stage} {count}" for stage, count in stats.server_errors.items() if count)
+    log.info(f"Server errors (HTTP 500): {server_errors or 'none'}")
+    log.info(f"SQLite lock contention: {stats.server_lock_errors} 'database is locked' errors logged by the server, {stats.token_lock_errors} token writes failed with 'database is locked'")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description = "Load test the Idena sign-in flow of a local auth.py instance")
+    parser.add_argument("--url", default = os.getenv("LOADTEST_URL", "http://127.0.0.1:5000"), help = "base URL of the auth instance")
+    parser.add_argument("-n", "--users", type = int, default = 500, help = "number of sign-ins to perform")
+    parser.add_argument("-c", "--concurrency", type = int, default = 20, help = "sign-ins in flight at once")
+    parser.add_argument("--signers", type = int, default = os.cpu_count(), help = "processes used to sign nonces")
+    args = parser.parse_args()
+
+    asyncio.run(run(args.url.rstrip("/"), args.users, args.concurrency, args.signers))
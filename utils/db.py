@@ -1,5 +1,7 @@
 import sqlite3
 import secrets
+import functools
+import threading
 from aiocache import cached
 from utils.logger import get_logger
 
@@ -7,27 +9,44 @@ log = get_logger("DB")
 
 conn = sqlite3.connect("bot.db", check_same_thread = False)
 cursor = conn.cursor()
+# auth.py runs its views on several threads and the interactions endpoint on its own loop thread, all sharing
+# this connection and cursor, so every function runs its statements, fetches and commit under this lock.
+# Reentrant because some functions call others, none of them suspend while holding it.
+lock = threading.RLock()
+
+def locked(func):
+    @functools.wraps(func)
+    async def wrapper(*args, **kwargs):
+        with lock:
+            return await func(*args, **kwargs)
+    return wrapper
 
 cursor.execute("CREATE TABLE IF NOT EXISTS guilds (guild_id TEXT PRIMARY KEY, undefined_role_id TEXT, newbie_role_id TEXT, verified_role_id TEXT, human_role_id TEXT, suspended_role_id TEXT, zombie_role_id TEXT, bot_manager_role_id TEXT)")
 cursor.execute("CREATE TABLE IF NOT EXISTS users (user_id TEXT PRIMARY KEY, address TEXT UNIQUE)") # discord user id
 cursor.execute("CREATE TABLE IF NOT EXISTS pending_auth (user_id TEXT PRIMARY KEY, token TEXT UNIQUE NOT NULL, address TEXT, nonce TEXT, created DATETIME DEFAULT CURRENT_TIMESTAMP)")
+cursor.execute("CREATE TABLE IF NOT EXISTS identities (address TEXT PRIMARY KEY, state TEXT, epoch INTEGER)") # local mirror of the node's identity set
+cursor.execute("CREATE TABLE IF NOT EXISTS role_jobs (job_id INTEGER PRIMARY KEY AUTOINCREMENT, guild_id TEXT, user_id TEXT, priority INTEGER, cooldown INTEGER DEFAULT 0, status TEXT DEFAULT 'pending', result TEXT, created DATETIME DEFAULT CURRENT_TIMESTAMP)") # role updates forwarded to the gateway process
 
+@locked
 async def add_guild(guild_id):
     cursor.execute("INSERT INTO guilds (guild_id) VALUES (?)", (guild_id,))
     log.info(f"Added guild {guild_id} to the database")
     conn.commit()
 
+@locked
 async def remove_guild(guild_id):
     cursor.execute("DELETE FROM guilds WHERE guild_id = ?", (guild_id,))
     log.info(f"Removed guild {guild_id} from the database")
     conn.commit()
 
+@locked
 async def set_bot_manager(guild_id, role_id):
     cursor.execute("UPDATE guilds SET bot_manager_role_id = ? WHERE guild_id = ?", (role_id, guild_id))
     log.info(f"Set bot manager role {role_id} in guild {guild_id}")
     conn.commit()
 
 @cached(ttl = 15)
+@locked
 async def get_bot_manager(guild_id):
     cursor.execute("SELECT bot_manager_role_id FROM guilds WHERE guild_id = ?", (guild_id,))
     bot_manager = cursor.fetchone()
@@ -35,6 +54,7 @@ async def get_bot_manager(guild_id):
         return None
     return int(bot_manager[0])
 
+@locked
 async def bind_role(guild_id, status: str, role_id):
     if status == "Not Validated":
         status = "undefined"
@@ -43,6 +63,7 @@ async def bind_role(guild_id, status: str, role_id):
     conn.commit()
 
 @cached(ttl = 15)
+@locked
 async def get_role_bindings(guild_id):
     if await guild_exists(guild_id) is False:
         return {"undefined": None, "newbie": None, "verified": None, "human": None, "suspended": None, "zombie": None}
@@ -59,12 +80,14 @@ async def is_guild_configured(guild_id) -> bool:
         return False
     return True
 
+@locked
 async def get_guilds():
     cursor.execute("SELECT guild_id FROM guilds")
     guilds = cursor.fetchall()
     guilds = [int(guild[0]) for guild in guilds]
     return guilds
 
+@locked
 async def guild_exists(guild_id, add_to_db = True) -> bool:
     cursor.execute("SELECT * FROM guilds WHERE guild_id = ?", (guild_id,))
     guild = cursor.fetchone()
@@ -76,6 +99,7 @@ async def guild_exists(guild_id, add_to_db = True) -> bool:
 
 # Auth functions
 
+@locked
 async def generate_token(user_id) -> str:
     token = secrets.token_hex(16)
     cursor.execute("DELETE FROM pending_auth WHERE user_id = ?", (user_id,))
@@ -84,6 +108,7 @@ async def generate_token(user_id) -> str:
     log.info(f"Generated token {token} for user id {user_id}")
     return token
 
+@locked
 async def generate_nonce(token, address) -> str:
     nonce = "signin-" + secrets.token_hex(16)
     cursor.execute("UPDATE pending_auth SET nonce = ?, address = ? WHERE token = ?", (nonce, address, token))
@@ -91,6 +116,7 @@ async def generate_nonce(token, address) -> str:
     log.info(f"Generated nonce {nonce} for token {token}")
     return nonce
 
+@locked
 async def set_user(user_id, address):
     try:
         cursor.execute("DELETE FROM users WHERE user_id = ?", (user_id,))
@@ -103,10 +129,12 @@ async def set_user(user_id, address):
     log.info(f"Set user {user_id} to address {address}")
     return True
 
+@locked
 async def delete_user(user_id):
     cursor.execute("DELETE FROM users WHERE user_id = ?", (user_id,))
     conn.commit()
 
+@locked
 async def get_discord_id(token) -> str:
     cursor.execute("SELECT user_id FROM pending_auth WHERE token = ?", (token,))
     user_id = cursor.fetchone()
@@ -114,6 +142,7 @@ async def get_discord_id(token) -> str:
         return None
     return int(user_id[0])
 
+@locked
 async def get_nonce(token) -> str:
     cursor.execute("SELECT nonce FROM pending_auth WHERE token = ?", (token,))
     nonce = cursor.fetchone()
@@ -121,6 +150,7 @@ async def get_nonce(token) -> str:
         return None
     return nonce[0]
 
+@locked
 async def get_pending_address(token) -> str:
     cursor.execute("SELECT address FROM pending_auth WHERE token = ?", (token,))
     address = cursor.fetchone()
@@ -128,12 +158,14 @@ async def get_pending_address(token) -> str:
         return None
     return address[0]
 
+@locked
 async def get_all_users():
     cursor.execute("SELECT user_id FROM users")
     users = cursor.fetchall()
     users = [int(user[0]) for user in users]
     return users
 
+@locked
 async def get_user_address(user_id) -> str:
     cursor.execute("SELECT address FROM users WHERE user_id = ?", (user_id,))
     address = cursor.fetchone()
@@ -141,14 +173,85 @@ async def get_user_address(user_id) -> str:
         return None
     return address[0]
 
+@locked
 async def remove_pending_auth(token):
     cursor.execute("DELETE FROM pending_auth WHERE token = ?", (token,))
     conn.commit()
 
+# Identity mirror functions
+
+@locked
+async def set_identities(identities: dict, epoch: int):
+    # replace the whole mirror with a fresh snapshot from the node
+    cursor.execute("DELETE FROM identities")
+    cursor.executemany("INSERT INTO identities (address, state, epoch) VALUES (?, ?, ?)", [(address.lower(), state, epoch) for address, state in identities.items()])
+    conn.commit()
+    log.info(f"Synced {len(identities)} identities for epoch {epoch}")
+
+@locked
+async def set_identity_state(address, state, epoch):
+    cursor.execute("INSERT OR REPLACE INTO identities (address, state, epoch) VALUES (?, ?, ?)", (address.lower(), state, epoch))
+    conn.commit()
+
+@locked
+async def get_identity_state(address) -> str:
+    cursor.execute("SELECT state FROM identities WHERE address = ?", (address.lower(),))
+    state = cursor.fetchone()
+    if state is None:
+        return None
+    return state[0]
+
+@locked
+async def get_identities_epoch() -> int:
+    cursor.execute("SELECT MAX(epoch) FROM identities")
+    return cursor.fetchone()[0]
+
+@locked
+async def get_unsynced_addresses():
+    cursor.execute("SELECT address FROM users WHERE lower(address) NOT IN (SELECT address FROM identities)")
+    addresses = cursor.fetchall()
+    addresses = [address[0] for address in addresses]
+    return addresses
+
+# Role job functions
+
+@locked
+async def add_role_job(guild_id, user_id, priority, cooldown = False) -> int:
+    # user_id None updates all users, guild_id None all guilds
+    cursor.execute("INSERT INTO role_jobs (guild_id, user_id, priority, cooldown) VALUES (?, ?, ?, ?)", (str(guild_id) if guild_id else None, str(user_id) if user_id else None, priority, int(cooldown)))
+    conn.commit()
+    return cursor.lastrowid
+
+@locked
+async def take_role_jobs():
+    cursor.execute("SELECT job_id, guild_id, user_id, priority, cooldown FROM role_jobs WHERE status = 'pending' ORDER BY priority, job_id")
+    jobs = cursor.fetchall()
+    cursor.executemany("UPDATE role_jobs SET status = 'running' WHERE job_id = ?", [(job[0],) for job in jobs])
+    conn.commit()
+    jobs = [(job[0], int(job[1]) if job[1] else None, int(job[2]) if job[2] else None, job[3], bool(job[4])) for job in jobs]
+    return jobs
+
+@locked
+async def finish_role_job(job_id, result, status = "done"):
+    cursor.execute("UPDATE role_jobs SET status = ?, result = ? WHERE job_id = ?", (status, result, job_id))
+    conn.commit()
+
+@locked
+async def get_role_job(job_id):
+    cursor.execute("SELECT status, result FROM role_jobs WHERE job_id = ?", (job_id,))
+    return cursor.fetchone()
+
+@locked
+async def remove_role_job(job_id):
+    cursor.execute("DELETE FROM role_jobs WHERE job_id = ?", (job_id,))
+    conn.commit()
+
 # cleanup function
+@locked
 async def clean():
     cursor.execute("DELETE FROM pending_auth WHERE created < datetime('now', '-1 hour')")
     rows_deleted = cursor.rowcount
+    cursor.execute("DELETE FROM role_jobs WHERE created < datetime('now', '-1 day')") # jobs left behind by stopped processes
     conn.commit()
     if rows_deleted > 0:
         log.info(f"Cleaned up {rows_deleted} expired tokens")
\ No newline at end of file
@@ -34,3 +34,29 @@ async def get_identity_state(address: str) -> str:
         if "error" in identity:
             return "undefined"
         return identity["result"]["state"]
+
+async def call_node(method: str, params: list):
+    call_data = {
+        "method": method,
+        "params": params,
+        "id": 1,
+        "key": NODE_KEY
+    }
+    async with aiohttp.ClientSession() as session:
+        async with session.post(NODE_URL, json = call_data, headers = {'Content-Type': 'application/json'}) as response:
+            result = await response.json()
+    if "result" not in result:
+        raise Exception(f"Error calling {method}: {result['error']}")
+    return result["result"]
+
+async def get_node_identity_state(address: str) -> str:
+    # raises instead of falling back to the Idena API
+    return (await call_node("dna_identity", [address]))["state"]
+
+async def get_epoch() -> int:
+    return (await call_node("dna_epoch", []))["epoch"]
+
+async def get_all_identities() -> dict:
+    # full identity set of the node, {address: state}
+    identities = await call_node("dna_identities", [])
+    return {identity["address"].lower(): identity["state"] for identity in identities}
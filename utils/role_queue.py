@@ -0,0 +1,122 @@
+import asyncio
+from collections import deque
+from utils.logger import get_logger
+
+log = get_logger("QUEUE")
+
+# priority classes, lower runs first
+INTERACTIVE = 0
+BULK = 1
+
+class Job:
+    def __init__(self, key, priority, work):
+        self.key = key # (guild_id, member_id)
+        self.priority = priority
+        self.work = work
+        self.future = asyncio.get_running_loop().create_future()
+
+class RoleUpdateQueue:
+    # Central queue for role updates so interactive requests don't wait behind bulk updates.
+    # Pending jobs are deduplicated per (guild, member), a member is never updated twice at once
+    # and bulk jobs are taken from guilds in turn so one large guild can't starve the others.
+
+    def __init__(self, workers: int = 3, bulk_workers: int = None):
+        # bulk jobs never take more than bulk_workers, by default all but one worker which stays free for interactive jobs
+        self.workers = workers
+        self.bulk_workers = workers - 1 if bulk_workers is None else min(bulk_workers, workers - 1)
+        self.interactive = deque()
+        self.bulk = {} # guild_id -> deque of jobs, iterated round robin
+        self.pending = {} # key -> queued job
+        self.running = set() # keys being processed, their queued jobs wait until done
+        self.bulk_running = 0
+        self.wakeup = None
+        self.tasks = []
+
+    def start(self):
+        if self.tasks:
+            return
+        self.wakeup = asyncio.Event()
+        self.tasks = [asyncio.create_task(self.worker()) for _ in range(self.workers)]
+        log.info(f"Started role update queue with {self.workers} workers ({self.bulk_workers} for bulk updates)")
+
+    def submit(self, guild_id: int, member_id: int, work, priority: int = INTERACTIVE) -> asyncio.Future:
+        # work is a coroutine function without arguments, the returned future resolves to its result
+        key = (guild_id, member_id)
+        job = self.pending.get(key)
+        if job is not None:
+            if priority < job.priority:
+                # promote the queued bulk job, its stale bulk entry is skipped when reached
+                # the newer work runs instead, the bulk one may hold a member fetched minutes ago
+                job.priority = priority
+                job.work = work
+                self.interactive.append(job)
+                self.notify()
+            return asyncio.shield(job.future)
+
+        job = Job(key, priority, work)
+        self.pending[key] = job
+        self.enqueue(job)
+        return asyncio.shield(job.future)
+
+    def enqueue(self, job: Job):
+        if job.priority == INTERACTIVE:
+            self.interactive.append(job)
+        else:
+            self.bulk.setdefault(job.key[0], deque()).append(job)
+        self.notify()
+
+    def notify(self):
+        if self.wakeup is not None: # not started yet otherwise, workers pick the jobs up once they run
+            self.wakeup.set()
+
+    def next_job(self) -> Job:
+        job = self.take(self.interactive, INTERACTIVE)
+        if job is not None or self.bulk_running >= self.bulk_workers:
+            return job
+
+        for guild_id in list(self.bulk):
+            # move the guild to the back so the next bulk job comes from another guild
+            jobs = self.bulk.pop(guild_id)
+            job = self.take(jobs, BULK)
+            if jobs:
+                self.bulk[guild_id] = jobs
+            if job is not None:
+                return job
+        return None
+
+    def take(self, jobs: deque, priority: int) -> Job:
+        # first job still queued with this priority whose member isn't being updated right now
+        for job in list(jobs):
+            if self.pending.get(job.key) is not job or job.priority != priority:
+                jobs.remove(job) # stale entry of a promoted job
+            elif job.key not in self.running:
+                jobs.remove(job)
+                return job
+        return None
+
+    async def worker(self):
+        while True:
+            # no await between picking and claiming a job, so workers can't take the same one
+            job = self.next_job()
+            if job is None:
+                self.wakeup.clear()
+                await self.wakeup.wait()
+                continue
+            del self.pending[job.key]
+            self.running.add(job.key)
+            if job.priority == BULK:
+                self.bulk_running += 1
+
+            try:
+                job.future.set_result(await job.work())
+            except Exception as e:
+                job.future.set_exception(e)
+            except BaseException as e:
+                # cancelled, don't leave the callers waiting
+                job.future.set_exception(e)
+                raise
+            finally:
+                self.running.discard(job.key)
+                if job.priority == BULK:
+                    self.bulk_running -= 1
+                self.notify()